@@ -6,7 +6,10 @@ from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from flask import jsonify
 import os
-from face_utils import extract_face, convert_image_to_vector, validate_student_face, to_pgvector
+from face_utils import (
+    extract_face, convert_image_to_vector, validate_student_face, vector_param,
+    vector_database_url, register_vector_codec,
+)
 
 
 app = Flask(__name__)
@@ -17,7 +20,8 @@ STUDENT_FOLDER = "uploads"
 os.makedirs(STUDENT_FOLDER,exist_ok=True)
 
 data_url = os.getenv("DATABASE_URL")
-engine = create_engine(os.getenv("DATABASE_URL"))
+engine = create_engine(vector_database_url(os.getenv("DATABASE_URL")))
+register_vector_codec(engine)
 
 # http://localhost:3000/register/student
 @app.route('/register/student',methods=['POST'])
@@ -36,14 +40,14 @@ def register_student():
             conn.execute(text("""
                 INSERT INTO students
                 (name, email, phone_number, department, face_embedding, passport_path)
-                VALUES (:name, :email, :phone_number, :department, :face_embedding, :passport_path)
+                VALUES (:name, :email, :phone_number, :department, (:face_embedding)::vector, :passport_path)
             """),
             {
                 "name": name,
                 "email": email,
                 "phone_number": phone_number,
                 "department": department,
-                "face_embedding": to_pgvector(face_embedding),
+                "face_embedding": vector_param(face_embedding),
                 "passport_path": passport_path
             }
             )
@@ -6,15 +6,40 @@ import numpy as np
 from sentence_transformers import SentenceTransformer
 from IPython.display import Image, display
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Embedding model used for registration and scanning. Changing it means every
+# stored face_embedding must be regenerated (see `flask reembed`).
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "clip-ViT-B-32")
+
+_cascades = threading.local()
+
+def _haar_cascade():
+    # detectMultiScale keeps per-call state inside the classifier, so every
+    # thread (Flask request threads, reembed workers) gets its own instance
+    haar_cascade = getattr(_cascades, "frontalface", None)
+    if haar_cascade is not None:
+        return haar_cascade
 
-# Extracting the face and preprocessing from the image
-def extract_face(passport_path):
     # load Haar cascade properly
     haar_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml" 
     haar_cascade = cv2.CascadeClassifier(haar_path)
 
     if haar_cascade.empty():
         raise RuntimeError("Failed to load Haarcascade. Please check your OpenCV installation.")
+    _cascades.frontalface = haar_cascade
+    return haar_cascade
+
+
+def _detect_passport_faces(passport_path):
+    haar_cascade = _haar_cascade()
 
     # read the image
     img = cv2.imread(passport_path)
@@ -29,6 +54,21 @@ def extract_face(passport_path):
 
     if len(faces) == 0:
         raise ValueError("No face detected in the image. Please upload a clearer passport photo.")
+    return img, faces
+
+
+def crop_face(passport_path):
+    """Same crop as extract_face, returned as an RGB PIL image instead of written to disk."""
+    from PIL import Image
+    img, faces = _detect_passport_faces(passport_path)
+    # extract_face hands back the last detected face, so match it
+    x, y, w, h = faces[-1]
+    return Image.fromarray(cv2.cvtColor(img[y:y+h, x:x+w], cv2.COLOR_BGR2RGB))
+
+
+# Extracting the face and preprocessing from the image
+def extract_face(passport_path):
+    img, faces = _detect_passport_faces(passport_path)
 
     os.makedirs("detected_faces", exist_ok=True)  # ensure folder exists
 
@@ -42,29 +82,269 @@ def extract_face(passport_path):
     return target_file_name
 
 
-def to_pgvector(embeddings):
-    return '[' + ','.join(str(x) for x in embeddings.tolist()) + ']'
+# ----------------------- pgvector codec -----------------------
+# Every embedding going to Postgres passes through vector_param(). With the
+# psycopg 3 driver and pgvector's adapters registered, the float32 buffer is
+# sent in pgvector's binary format instead of a 512-number text literal that
+# Postgres has to parse again (psycopg2 only supports the text format).
+
+def vector_param(embedding):
+    return np.ascontiguousarray(embedding, dtype=np.float32).ravel()
+
+
+def vector_database_url(url):
+    # prefer psycopg 3 for plain postgresql:// URLs when it is installed
+    scheme, sep, rest = url.partition("://")
+    if scheme not in ("postgres", "postgresql") or not sep:
+        return url
+    try:
+        import psycopg  # noqa: F401
+    except ImportError:
+        return url
+    return "postgresql+psycopg://" + rest
+
+
+def register_vector_codec(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "connect")
+    def _register_vector(dbapi_conn, connection_record):
+        if engine.dialect.driver == "psycopg":
+            from pgvector.psycopg import register_vector
+        else:
+            from pgvector.psycopg2 import register_vector
+        try:
+            register_vector(dbapi_conn)
+        except Exception as e:
+            # without the adapters numpy embeddings can't be bound at all, so refuse the
+            # connection (the pool discards it) instead of failing on every scan later
+            raise RuntimeError(
+                f"Could not register pgvector types ({e}). Run `CREATE EXTENSION vector;` in the database."
+            ) from e
+
+
+class FrameQualityGate:
+    """
+    Cheap checks on a scanner frame before it is embedded: sharpness (variance of
+    the Laplacian), mean brightness, and presence/size of a face from the Haar
+    detector. Frames that fail can never match confidently, so they are rejected
+    before CLIP inference and the vector search. Thresholds come from QUALITY_* env vars.
+    """
+    MESSAGES = {
+        "unreadable": "Could not read the image",
+        "too_dark": "Image too dark, please improve lighting",
+        "too_bright": "Image overexposed, please reduce glare",
+        "blurry": "Image too blurry, please hold still",
+        "no_face": "No face detected, please face the camera",
+        "face_too_small": "Face too far away, please step closer",
+    }
 
+    def __init__(self):
+        self.enabled = os.getenv("QUALITY_GATE", "1") not in ("0", "false", "False")
+        self.min_sharpness = float(os.getenv("QUALITY_MIN_SHARPNESS", "50"))
+        self.min_brightness = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "40"))
+        self.max_brightness = float(os.getenv("QUALITY_MAX_BRIGHTNESS", "220"))
+        self.min_face_px = int(os.getenv("QUALITY_MIN_FACE_PX", "48"))
+        self.max_side = int(os.getenv("QUALITY_ANALYSIS_SIDE", "640"))
+        self._lock = threading.Lock()
+        self._counts = {"passed": 0, **{reason: 0 for reason in self.MESSAGES}}
 
-def convert_image_to_vector(image_path):
+    def check(self, image_path):
+        """Return (reason, metrics); reason is None when the frame may go on to embedding."""
+        if not self.enabled:
+            return None, {}
+        reason, metrics = self._assess(image_path)
+        with self._lock:
+            self._counts[reason or "passed"] += 1
+        return reason, metrics
+
+    def _assess(self, image_path):
+        img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            return "unreadable", {}
+        # analyse a downscaled copy; face size is reported in original pixels
+        scale = min(1.0, self.max_side / float(max(img.shape[:2])))
+        gray = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else img
+
+        brightness = float(gray.mean())
+        sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+        metrics = {"brightness": round(brightness, 1), "sharpness": round(sharpness, 1)}
+        if brightness < self.min_brightness:
+            return "too_dark", metrics
+        if brightness > self.max_brightness:
+            return "too_bright", metrics
+        if sharpness < self.min_sharpness:
+            return "blurry", metrics
+
+        faces = _haar_cascade().detectMultiScale(gray, 1.1, minNeighbors=5, minSize=(24, 24))
+        if len(faces) == 0:
+            return "no_face", metrics
+        face_px = int(max(min(w, h) for _, _, w, h in faces) / scale)
+        metrics["face_px"] = face_px
+        if face_px < self.min_face_px:
+            return "face_too_small", metrics
+        return None, metrics
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            "thresholds": {
+                "min_sharpness": self.min_sharpness,
+                "min_brightness": self.min_brightness,
+                "max_brightness": self.max_brightness,
+                "min_face_px": self.min_face_px,
+            },
+            "enabled": self.enabled,
+            "counts": counts,
+            "rejected": sum(v for k, v in counts.items() if k != "passed"),
+        }
+
+
+frame_quality_gate = FrameQualityGate()
+
+
+@lru_cache(maxsize=2)
+def get_model(model_name=EMBEDDING_MODEL):
+    # loading CLIP takes seconds, so keep the instance around between calls
+    return SentenceTransformer(model_name)
+
+
+class InferenceBatcher:
+    """
+    Micro-batching front for the embedding model. Images submitted by concurrent
+    requests within `window_ms` (or until `max_batch` are queued) are encoded in a
+    single forward pass and each caller gets its own row back. A request that
+    arrives while nothing else is queued is dispatched straight away, so the window
+    only costs latency once there is concurrency to batch. `model_name` is the
+    default; callers may name another model per image (e.g. right after a re-embed switch).
+    """
+    BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+    WAIT_BUCKETS_MS = (1, 5, 10, 20, 50, 100, 250, 1000)
+
+    def __init__(self, window_ms=10, max_batch=16, model_name=EMBEDDING_MODEL):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.model_name = model_name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._last_batch_size = 1
+        self._batch_hist = self._empty_hist(self.BATCH_BUCKETS)
+        self._wait_hist = self._empty_hist(self.WAIT_BUCKETS_MS)
+
+    @staticmethod
+    def _empty_hist(buckets):
+        return {"buckets": {str(b): 0 for b in buckets + ("+Inf",)}, "count": 0, "sum": 0.0}
+
+    @staticmethod
+    def _observe(hist, bounds, value):
+        key = next((str(b) for b in bounds if value <= b), "+Inf")
+        hist["buckets"][key] += 1
+        hist["count"] += 1
+        hist["sum"] += value
+
+    def encode(self, img, model_name=None):
+        return self.submit(img, model_name).result()
+
+    def submit(self, img, model_name=None):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+                    self._thread.start()
+        fut = Future()
+        self._queue.put((time.monotonic(), img, fut, model_name or self.model_name))
+        return fut
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "queued": self._queue.qsize(),
+                "batch_size": {**self._batch_hist, "buckets": dict(self._batch_hist["buckets"])},
+                "queue_wait_ms": {**self._wait_hist, "buckets": dict(self._wait_hist["buckets"])},
+            }
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][0] + self.window
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # only hold the batch open when callers are actually arriving together
+        if len(batch) > 1 or self._last_batch_size > 1:
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        self._last_batch_size = len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            with self._stats_lock:
+                self._observe(self._batch_hist, self.BATCH_BUCKETS, len(batch))
+                for enqueued, _, _, _ in batch:
+                    self._observe(self._wait_hist, self.WAIT_BUCKETS_MS, (started - enqueued) * 1000)
+            by_model = {}
+            for item in batch:
+                by_model.setdefault(item[3], []).append(item)
+            for model_name, items in by_model.items():
+                try:
+                    vectors = get_model(model_name).encode(
+                        [img for _, img, _, _ in items], batch_size=len(items), normalize_embeddings=True
+                    )
+                except Exception as e:
+                    for _, _, fut, _ in items:
+                        fut.set_exception(e)
+                    continue
+                for (_, _, fut, _), vec in zip(items, vectors):
+                    fut.set_result(vec)
+
+
+inference_batcher = InferenceBatcher(
+    window_ms=float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "10")),
+    max_batch=int(os.getenv("INFERENCE_MAX_BATCH", "16")),
+)
+
+
+def convert_image_to_vector(image_path, model_name=EMBEDDING_MODEL):
+    # pass the model the stored embeddings were made with (runapp.active_embedding_model)
     from PIL import Image
-    img = Image.open(image_path)
-    model = SentenceTransformer("clip-ViT-B-32")
-    embeddings = model.encode(img, normalize_embeddings=True)
-    return embeddings
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+    if inference_batcher.max_batch <= 1:
+        return get_model(model_name).encode(img, normalize_embeddings=True)
+    return inference_batcher.encode(img, model_name)
+
+
+def convert_images_to_vectors(images, model_name=EMBEDDING_MODEL, batch_size=32):
+    # batched variant for bulk jobs; `images` are already opened PIL images
+    model = get_model(model_name)
+    return model.encode(images, batch_size=batch_size, normalize_embeddings=True)
 
 
 def validate_student_face(embedding):
     from app_test import engine, text
     try:
-        embedding_str = to_pgvector(embedding)
         with engine.begin() as conn:
             row = conn.execute(
                 text(
                     "SELECT student_id, passport_path, face_embedding <=> (:embedding)::vector AS distance "
                     "FROM students ORDER BY distance LIMIT 1;"
                 ),
-                {"embedding": embedding_str}
+                {"embedding": vector_param(embedding)}
             ).fetchone()
 
             if row is None or row.distance > 0.25:
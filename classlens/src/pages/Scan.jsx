@@ -71,7 +71,7 @@ export default function Scan() {
       const data = await res.json();
       if (res.ok) {
         setStatus(`${data.result}`);
-        if (data.result == "Match Not Found"){
+        if (data.result == "Match Not Found" || String(data.status || "").startsWith("rejected_")){
 
         }
         else{